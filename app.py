@@ -1,48 +1,437 @@
-from fastapi import FastAPI, File, UploadFile, Form
-from fastapi.responses import FileResponse, JSONResponse
+from fastapi import FastAPI, File, HTTPException, UploadFile, Form, Request, WebSocket, WebSocketDisconnect
+from fastapi.responses import FileResponse, ORJSONResponse, Response, StreamingResponse
+from starlette.background import BackgroundTask
+from starlette.datastructures import Headers
 import uvicorn
+import asyncio
+import io
 import tempfile
 import os
-from whisper_demo import transcribe_audio
-from chatterbox_demo import synthesize_tts
-import gradio as gr
+import hashlib
+import json
+import time
+from pathlib import Path
+from concurrent.futures import ThreadPoolExecutor
+from contextlib import asynccontextmanager
 import threading
+import multiprocessing
 
-app = FastAPI()
+ENABLE_GRADIO = os.environ.get("ENABLE_GRADIO", "0") == "1"
+GRADIO_API_URL = os.environ.get("GRADIO_API_URL", "http://127.0.0.1:7860")
+
+TTS_CACHE_DIR = Path.home() / ".cache" / "chatterbox" / "tts"
+TTS_CACHE_ENABLED = os.environ.get("CHATTERBOX_NO_TTS_CACHE") != "1"
+TTS_CACHE_MAX_BYTES = int(os.environ.get("TTS_CACHE_MAX_BYTES", 2 << 30))
+TTS_CACHE_SWEEP_INTERVAL = 300
+STAGING_MAX_AGE = 3600
+TTS_CACHE_CONTROL = "public, max-age=86400"
+
+TRANSCRIPT_CACHE_DIR = Path.home() / ".cache" / "chatterbox" / "transcripts"
+TRANSCRIPT_CACHE_ENABLED = os.environ.get("CHATTERBOX_NO_TRANSCRIPT_CACHE") != "1"
+
+UPLOAD_CHUNK_SIZE = 1 << 20
+MAX_UPLOAD_BYTES = int(os.environ.get("MAX_UPLOAD_BYTES", 100 << 20))
+
+INFERENCE_CONCURRENCY = int(os.environ.get("INFERENCE_CONCURRENCY", "2"))
+INFERENCE_POOL = ThreadPoolExecutor(max_workers=INFERENCE_CONCURRENCY)
+
+_inflight = {}
+
+whisper_demo = None
+chatterbox_demo = None
+_warmup_done = False
+_warmup_error = None
+
+def load_models():
+    global whisper_demo, chatterbox_demo
+    import whisper_demo
+    import chatterbox_demo
+
+def warm_models():
+    global _warmup_done, _warmup_error
+    try:
+        with ThreadPoolExecutor(max_workers=2) as pool:
+            for future in [pool.submit(whisper_demo.warmup), pool.submit(chatterbox_demo.warmup)]:
+                future.result()
+        _warmup_done = True
+    except Exception as exc:
+        _warmup_error = repr(exc)
+        raise
+
+@asynccontextmanager
+async def lifespan(app):
+    load_models()
+    # Requests that arrive mid-warmup wait on the model locks; /health reports progress meanwhile.
+    threading.Thread(target=warm_models, daemon=True).start()
+    if TTS_CACHE_ENABLED or TRANSCRIPT_CACHE_ENABLED:
+        threading.Thread(target=cache_sweeper, daemon=True).start()
+    if ENABLE_GRADIO:
+        multiprocessing.get_context("spawn").Process(target=launch_gradio, daemon=True).start()
+    yield
+
+app = FastAPI(lifespan=lifespan, default_response_class=ORJSONResponse)
+
+class UploadLimitMiddleware:
+    def __init__(self, app):
+        self.app = app
+
+    async def __call__(self, scope, receive, send):
+        if scope["type"] != "http" or not scope["path"].startswith("/transcribe"):
+            await self.app(scope, receive, send)
+            return
+        rejection = ORJSONResponse({"detail": "Upload too large"}, status_code=413)
+        if int(Headers(scope=scope).get("content-length", "0")) > MAX_UPLOAD_BYTES:
+            await rejection(scope, receive, send)
+            return
+        received = 0
+
+        async def receive_within_limit():
+            nonlocal received
+            message = await receive()
+            received += len(message.get("body", b""))
+            if received > MAX_UPLOAD_BYTES:
+                raise HTTPException(413, "Upload too large")
+            return message
+
+        async def send_unless_rejected(message):
+            if received <= MAX_UPLOAD_BYTES:
+                await send(message)
+
+        await self.app(scope, receive_within_limit, send_unless_rejected)
+        if received > MAX_UPLOAD_BYTES:
+            await rejection(scope, receive, send)
+
+app.add_middleware(UploadLimitMiddleware)
+
+@app.get("/health")
+async def health():
+    if _warmup_error is not None:
+        status = "error"
+    else:
+        status = "ok" if _warmup_done else "loading"
+    return {
+        "status": status,
+        "whisper_loaded": whisper_demo.is_loaded(),
+        "tts_loaded": chatterbox_demo.is_loaded(),
+        "error": _warmup_error,
+    }
+
+@app.get("/voices")
+async def voices(refresh: bool = False):
+    loop = asyncio.get_running_loop()
+    if refresh:
+        await loop.run_in_executor(None, chatterbox_demo.refresh_voices)
+    options = await loop.run_in_executor(None, chatterbox_demo.get_voice_options)
+    default = await loop.run_in_executor(None, chatterbox_demo.default_voice)
+    return {"voices": options, "default": str(default)}
+
+def tts_cache_key(text, voice_name=None):
+    normalized = " ".join(chatterbox_demo.clip_text(text).split())
+    voice = chatterbox_demo.resolve_voice(voice_name)
+    return hashlib.sha256(f"{chatterbox_demo.model_tag()}\0{voice}\0{normalized}".encode()).hexdigest()
+
+def tts_cache_get(key):
+    path = TTS_CACHE_DIR / f"{key}.wav"
+    try:
+        # LRU recency lives in atime so mtime, and with it the ETag, only changes on a re-render.
+        os.utime(path, ns=(time.time_ns(), path.stat().st_mtime_ns))
+    except FileNotFoundError:
+        return None
+    return str(path)
+
+def tts_cache_render(key, text, voice_name=None):
+    staging_dir = TTS_CACHE_DIR / "staging"
+    staging_dir.mkdir(parents=True, exist_ok=True)
+    fd, staging_path = tempfile.mkstemp(dir=staging_dir, suffix=".wav")
+    os.close(fd)
+    cached_path = TTS_CACHE_DIR / f"{key}.wav"
+    try:
+        chatterbox_demo.synthesize_tts(text, voice_name, output_path=staging_path)
+    except Exception:
+        Path(staging_path).unlink(missing_ok=True)
+        raise
+    os.replace(staging_path, cached_path)
+    return str(cached_path)
+
+def tts_cache_evict():
+    entries = []
+    try:
+        with os.scandir(TTS_CACHE_DIR) as it:
+            for entry in it:
+                if entry.name.endswith(".wav"):
+                    stat = entry.stat()
+                    entries.append((stat.st_atime, stat.st_size, entry.path))
+    except FileNotFoundError:
+        return
+    total = sum(size for _, size, _ in entries)
+    for _, size, path in sorted(entries):
+        if total <= TTS_CACHE_MAX_BYTES:
+            break
+        Path(path).unlink(missing_ok=True)
+        total -= size
+
+def remove_stale_files(directory, pattern):
+    cutoff = time.time() - STAGING_MAX_AGE
+    for path in directory.glob(pattern):
+        try:
+            if path.stat().st_mtime < cutoff:
+                path.unlink(missing_ok=True)
+        except FileNotFoundError:
+            pass
+
+def cache_sweeper():
+    # Staging files are normally renamed or unlinked; this catches ones orphaned by a crash.
+    while True:
+        time.sleep(TTS_CACHE_SWEEP_INTERVAL)
+        if TTS_CACHE_ENABLED:
+            tts_cache_evict()
+            remove_stale_files(TTS_CACHE_DIR / "staging", "*.wav")
+        if TRANSCRIPT_CACHE_ENABLED:
+            remove_stale_files(TRANSCRIPT_CACHE_DIR, "*.tmp")
+
+def cached_synthesize_tts(text, voice_name=None, key=None):
+    if not TTS_CACHE_ENABLED:
+        return chatterbox_demo.synthesize_tts(text, voice_name)
+    if key is None:
+        key = tts_cache_key(text, voice_name)
+    cached_path = tts_cache_get(key)
+    if cached_path is not None:
+        return cached_path
+    return tts_cache_render(key, text, voice_name)
+
+def transcript_cache_key(digest, vad_filter=True, fast=True):
+    return f"{digest}_{whisper_demo.cache_tag(vad_filter, fast)}"
+
+def transcript_cache_get(key):
+    try:
+        with open(TRANSCRIPT_CACHE_DIR / f"{key}.json") as f:
+            return json.load(f)["transcription"]
+    except (OSError, ValueError, KeyError):
+        return None
+
+def transcript_cache_put(key, transcription):
+    TRANSCRIPT_CACHE_DIR.mkdir(parents=True, exist_ok=True)
+    cache_path = TRANSCRIPT_CACHE_DIR / f"{key}.json"
+    fd, staging_path = tempfile.mkstemp(dir=TRANSCRIPT_CACHE_DIR, suffix=".tmp")
+    try:
+        with os.fdopen(fd, "w") as f:
+            json.dump({"transcription": transcription, "model": whisper_demo.MODEL_TAG, "created": time.time()}, f)
+        os.replace(staging_path, cache_path)
+    finally:
+        Path(staging_path).unlink(missing_ok=True)
+
+def stream_sha256(f):
+    hasher = hashlib.sha256()
+    while chunk := f.read(UPLOAD_CHUNK_SIZE):
+        hasher.update(chunk)
+    f.seek(0)
+    return hasher.hexdigest()
+
+def transcribe_and_cache(key, audio, vad_filter=True, fast=True):
+    result = whisper_demo.transcribe_audio(audio, vad_filter, fast)
+    if TRANSCRIPT_CACHE_ENABLED:
+        try:
+            transcript_cache_put(key, result)
+        except OSError:
+            pass
+    return result
+
+async def run_once(key, fn, *args, release=None):
+    future = _inflight.get(key)
+    if future is None:
+        future = asyncio.get_running_loop().run_in_executor(INFERENCE_POOL, fn, *args)
+        _inflight[key] = future
+        future.add_done_callback(lambda _: _inflight.pop(key, None))
+        if release is not None:
+            future.add_done_callback(lambda _: release())
+    elif release is not None:
+        release()
+    return await asyncio.shield(future)
+
+async def transcribe_upload(file, vad_filter, fast):
+    loop = asyncio.get_running_loop()
+    digest = await loop.run_in_executor(None, stream_sha256, file.file)
+    key = transcript_cache_key(digest, vad_filter, fast)
+    if TRANSCRIPT_CACHE_ENABLED:
+        cached = await loop.run_in_executor(None, transcript_cache_get, key)
+        if cached is not None:
+            return {"transcription": cached}
+    # The pooled job can outlive this request, so it takes the upload over from FastAPI and closes it itself.
+    upload, file.file = file.file, io.BytesIO()
+    result = await run_once(f"transcribe:{key}", transcribe_and_cache, key, upload, vad_filter, fast, release=upload.close)
+    return {"transcription": result}
 
 @app.post("/transcribe")
-async def transcribe(file: UploadFile = File(...)):
-    with tempfile.NamedTemporaryFile(delete=False, suffix=".wav") as tmp:
-        tmp.write(await file.read())
-        tmp_path = tmp.name
-    result = transcribe_audio(tmp_path)
-    os.unlink(tmp_path)
-    return JSONResponse({"transcription": result})
+async def transcribe(file: UploadFile = File(...), vad_filter: bool = Form(True)):
+    return await transcribe_upload(file, vad_filter, fast=True)
+
+@app.post("/transcribe/accurate")
+async def transcribe_accurate(file: UploadFile = File(...), vad_filter: bool = Form(True)):
+    return await transcribe_upload(file, vad_filter, fast=False)
+
+def etag_matches(etag, if_none_match):
+    if if_none_match is None:
+        return False
+    tags = [tag.strip() for tag in if_none_match.split(",")]
+    return "*" in tags or etag in tags
+
+async def run_voice_lookup(fn, *args):
+    try:
+        return await asyncio.get_running_loop().run_in_executor(None, fn, *args)
+    except ValueError as exc:
+        raise HTTPException(422, str(exc))
 
 @app.post("/synthesize")
-async def synthesize(text: str = Form(...)):
-    audio_path = synthesize_tts(text)
-    return FileResponse(audio_path, media_type="audio/wav", filename="output.wav")
+async def synthesize(request: Request, text: str = Form(...), voice: str = Form(None)):
+    loop = asyncio.get_running_loop()
+    if not TTS_CACHE_ENABLED:
+        await run_voice_lookup(chatterbox_demo.resolve_voice, voice)
+        audio_path = await loop.run_in_executor(INFERENCE_POOL, chatterbox_demo.synthesize_tts, text, voice)
+        cleanup = BackgroundTask(Path(audio_path).unlink, missing_ok=True)
+        return FileResponse(audio_path, media_type="audio/wav", filename="output.wav", background=cleanup)
+    # Resolving the voice can rescan the voice list, so the key is built off the event loop.
+    key = await run_voice_lookup(tts_cache_key, text, voice)
+    audio_path = await run_once(f"synthesize:{key}", cached_synthesize_tts, text, voice, key)
+    # Sampling is not deterministic, so the ETag follows the cached file rather than the request.
+    stat = await loop.run_in_executor(None, os.stat, audio_path)
+    headers = {"ETag": f'"{stat.st_ino:x}-{stat.st_mtime_ns:x}-{stat.st_size:x}"', "Cache-Control": TTS_CACHE_CONTROL}
+    if etag_matches(headers["ETag"], request.headers.get("if-none-match")):
+        # If-None-Match on an unsafe method is a failed precondition, not a cache revalidation.
+        return Response(status_code=412, headers=headers)
+    return FileResponse(audio_path, media_type="audio/wav", filename="output.wav", headers=headers)
+
+async def iterate_in_inference_pool(iterator):
+    loop = asyncio.get_running_loop()
+    done = object()
+    pending = None
+    try:
+        while True:
+            pending = loop.run_in_executor(INFERENCE_POOL, next, iterator, done)
+            chunk = await asyncio.shield(pending)
+            if chunk is done:
+                break
+            yield chunk
+    finally:
+        # A cancelled consumer can leave next() running on a pool thread; close once it returns.
+        if pending is None:
+            iterator.close()
+        else:
+            pending.add_done_callback(lambda _: iterator.close())
+
+@app.post("/synthesize/stream")
+async def synthesize_stream(text: str = Form(...), voice: str = Form(None)):
+    if not text.strip():
+        raise HTTPException(422, "Text must not be empty")
+    await run_voice_lookup(chatterbox_demo.resolve_voice, voice)
+    return StreamingResponse(
+        iterate_in_inference_pool(chatterbox_demo.synthesize_tts_stream(text, voice)),
+        media_type="audio/wav",
+        headers={"Content-Disposition": "attachment; filename=output.wav"},
+    )
+
+@app.websocket("/synthesize/ws")
+async def synthesize_ws(websocket: WebSocket):
+    await websocket.accept()
+    message = await websocket.receive()
+    if message["type"] == "websocket.disconnect":
+        return
+    if message.get("text") is None:
+        await websocket.close(code=1008, reason="Expected a JSON text frame")
+        return
+    try:
+        request = json.loads(message["text"])
+    except ValueError:
+        await websocket.close(code=1008, reason="Invalid JSON")
+        return
+    text = request.get("text") if isinstance(request, dict) else None
+    voice = request.get("voice") if isinstance(request, dict) else None
+    if not isinstance(text, str) or not text.strip() or not isinstance(voice, (str, type(None))):
+        await websocket.close(code=1008, reason="Expected {\"text\": str, \"voice\": str | null}")
+        return
+    try:
+        await asyncio.get_running_loop().run_in_executor(None, chatterbox_demo.resolve_voice, voice)
+    except ValueError as exc:
+        await websocket.close(code=1008, reason=str(exc))
+        return
+    chunks = iterate_in_inference_pool(chatterbox_demo.synthesize_tts_stream(text, voice))
+    try:
+        async for chunk in chunks:
+            await websocket.send_bytes(chunk)
+    except WebSocketDisconnect:
+        return
+    finally:
+        await chunks.aclose()
+    await websocket.close()
 
 def launch_gradio():
+    import gradio as gr
+    import httpx
+    import chatterbox_demo
+
+    client = httpx.Client(base_url=GRADIO_API_URL, timeout=None)
+
+    def transcribe_via_api(audio, vad_filter, fast):
+        if audio is None:
+            return "Please upload or record audio first."
+        with open(audio, "rb") as f:
+            response = client.post(
+                "/transcribe" if fast else "/transcribe/accurate",
+                files={"file": f},
+                data={"vad_filter": str(vad_filter).lower()},
+            )
+        response.raise_for_status()
+        return response.json()["transcription"]
+
+    def synthesize_via_api(text, voice_name):
+        data = {"text": text}
+        if voice_name:
+            data["voice"] = voice_name
+        response = client.post("/synthesize", data=data)
+        response.raise_for_status()
+        return chatterbox_demo.read_wav(io.BytesIO(response.content))
+
+    def fetch_voices(refresh=False):
+        response = client.get("/voices", params={"refresh": str(refresh).lower()})
+        response.raise_for_status()
+        return response.json()
+
+    def load_voice_dropdown():
+        voices = fetch_voices()
+        return gr.update(choices=voices["voices"], value=voices["default"])
+
+    def refresh_voice_dropdown():
+        return gr.update(choices=fetch_voices(refresh=True)["voices"])
+
     with gr.Blocks() as demo:
         gr.Markdown("## 🗣️ Chatterbox TTS and Faster-Whisper Demo")
 
         with gr.Tab("Transcribe Audio (Whisper)"):
             audio_input = gr.Audio(type="filepath")
+            with gr.Row():
+                vad_checkbox = gr.Checkbox(value=True, label="Skip silence (VAD)")
+                fast_checkbox = gr.Checkbox(value=True, label="Fast mode")
             transcribe_btn = gr.Button("Transcribe")
             transcription_output = gr.Textbox()
-            transcribe_btn.click(transcribe_audio, inputs=audio_input, outputs=transcription_output)
+            transcribe_btn.click(
+                transcribe_via_api,
+                inputs=[audio_input, vad_checkbox, fast_checkbox],
+                outputs=transcription_output,
+            )
 
         with gr.Tab("Synthesize Speech (Chatterbox)"):
             text_input = gr.Textbox(label="Enter text")
+            with gr.Row():
+                voice_dropdown = gr.Dropdown(choices=[], label="Voice")
+                refresh_voices_btn = gr.Button("Refresh voices")
             synthesize_btn = gr.Button("Synthesize")
             audio_output = gr.Audio()
-            synthesize_btn.click(synthesize_tts, inputs=text_input, outputs=audio_output)
+            refresh_voices_btn.click(refresh_voice_dropdown, outputs=voice_dropdown)
+            synthesize_btn.click(synthesize_via_api, inputs=[text_input, voice_dropdown], outputs=audio_output)
 
-    demo.launch(server_name="0.0.0.0", server_port=7861)
+        demo.load(load_voice_dropdown, outputs=voice_dropdown)
 
-threading.Thread(target=launch_gradio).start()
+    demo.queue(default_concurrency_limit=INFERENCE_CONCURRENCY)
+    demo.launch(server_name="0.0.0.0", server_port=7861)
 
 if __name__ == "__main__":
-    uvicorn.run(app, host="0.0.0.0", port=7860)
+    uvicorn.run(app, host="0.0.0.0", port=7860, access_log=False, timeout_keep_alive=30)
@@ -1,10 +1,194 @@
-from chatterbox import TTS
+import contextlib
+import logging
+import numpy as np
 import tempfile
+import os
+import re
+from pathlib import Path
+import struct
+import threading
+import time
+import wave
 
-tts = TTS()
-voice = tts.list_voices()[0]
+SENTENCE_BOUNDARY = re.compile(r"(?<=[.!?])\s+")
+VOICE_LIST_TTL = 300
+COMPILE_MODEL = os.environ.get("CHATTERBOX_COMPILE") == "1"
+QUANTIZE = os.environ.get("CHATTERBOX_QUANTIZE", "")
+AUTOCAST = os.environ.get("CHATTERBOX_AUTOCAST") == "1"
+MAX_TEXT_CHARS = int(os.environ.get("CHATTERBOX_MAX_TEXT_CHARS", "5000"))
+SCRATCH_DIR = os.environ.get("CHATTERBOX_SCRATCH_DIR")
 
-def synthesize_tts(text):
-    with tempfile.NamedTemporaryFile(delete=False, suffix=".wav") as out:
-        tts.synthesize(text=text, voice=voice, output_path=out.name)
-        return out.name
+logger = logging.getLogger(__name__)
+
+_tts = None
+_tts_lock = threading.Lock()
+_model_tag = None
+_voice_list = {"voices": [], "labels": [], "by_label": {}, "loaded_at": 0.0}
+
+def get_tts():
+    global _tts, _model_tag
+    if _tts is None:
+        with _tts_lock:
+            if _tts is None:
+                import torch
+                from chatterbox import TTS
+
+                torch.set_float32_matmul_precision("high")
+                tts = TTS()
+                if QUANTIZE not in ("", "int8"):
+                    logger.warning("Ignoring unsupported CHATTERBOX_QUANTIZE=%s", QUANTIZE)
+                quantized = QUANTIZE == "int8" and quantize_model(tts)
+                compiled = COMPILE_MODEL and compile_model(tts)
+                autocast = AUTOCAST and torch.cuda.is_available()
+                if AUTOCAST and not autocast:
+                    logger.warning("Skipping autocast: CUDA is not available")
+                # The cache key reflects what was applied, not what was requested.
+                _model_tag = f"chatterbox-{'int8' if quantized else 'full'}-{'autocast' if autocast else 'fp32'}-{'compiled' if compiled else 'eager'}"
+                _tts = tts
+    return _tts
+
+def model_tag():
+    get_tts()
+    return _model_tag
+
+def is_loaded():
+    return _tts is not None
+
+def quantize_model(tts):
+    import torch
+
+    model = getattr(tts, "model", None)
+    if not isinstance(model, torch.nn.Module):
+        logger.warning("Skipping int8 quantization: TTS model is not a torch module")
+        return False
+    if torch.cuda.is_available():
+        logger.warning("Skipping int8 quantization: dynamic quantization only runs on CPU")
+        return False
+    tts.model = torch.ao.quantization.quantize_dynamic(model, {torch.nn.Linear}, dtype=torch.qint8)
+    return True
+
+def compile_model(tts):
+    import torch
+
+    model = getattr(tts, "model", None)
+    if not isinstance(model, torch.nn.Module):
+        logger.warning("Skipping torch.compile: TTS model is not a torch module")
+        return False
+    if not torch.cuda.is_available():
+        logger.warning("Skipping torch.compile: CUDA is not available")
+        return False
+    tts.model = torch.compile(model, mode="reduce-overhead")
+    return True
+
+def autocast_context():
+    import torch
+
+    if not AUTOCAST or not torch.cuda.is_available():
+        return contextlib.nullcontext()
+    dtype = torch.bfloat16 if torch.cuda.is_bf16_supported() else torch.float16
+    return torch.autocast("cuda", dtype=dtype)
+
+def list_voices():
+    if not _voice_list["voices"] or time.monotonic() - _voice_list["loaded_at"] > VOICE_LIST_TTL:
+        refresh_voices()
+    return _voice_list["voices"]
+
+def refresh_voices():
+    voices = get_tts().list_voices()
+    _voice_list["by_label"] = {str(v): v for v in voices}
+    _voice_list["labels"] = list(_voice_list["by_label"])
+    _voice_list["voices"] = voices
+    _voice_list["loaded_at"] = time.monotonic()
+    return _voice_list["voices"]
+
+def default_voice():
+    return list_voices()[0]
+
+def get_voice_options():
+    list_voices()
+    return _voice_list["labels"]
+
+def resolve_voice(voice_name=None):
+    if not voice_name:
+        return default_voice()
+    list_voices()
+    if voice_name not in _voice_list["by_label"]:
+        raise ValueError(f"Unknown voice: {voice_name}")
+    return _voice_list["by_label"][voice_name]
+
+def clip_text(text):
+    if len(text) <= MAX_TEXT_CHARS:
+        return text
+    clipped = text[:MAX_TEXT_CHARS]
+    return clipped.rsplit(None, 1)[0] if " " in clipped else clipped
+
+def synthesize_tts(text, voice_name=None, output_path=None):
+    import torch
+
+    scratch = output_path is None
+    if scratch:
+        if SCRATCH_DIR:
+            os.makedirs(SCRATCH_DIR, exist_ok=True)
+        fd, output_path = tempfile.mkstemp(suffix=".wav", dir=SCRATCH_DIR)
+        os.close(fd)
+    try:
+        with torch.inference_mode(), autocast_context():
+            get_tts().synthesize(text=clip_text(text), voice=resolve_voice(voice_name), output_path=output_path)
+    except Exception:
+        if scratch:
+            Path(output_path).unlink(missing_ok=True)
+        raise
+    return output_path
+
+def streaming_wav_header(channels, sample_width, frame_rate):
+    # Sizes are unknown up front, so both length fields use the 0xFFFFFFFF placeholder.
+    return struct.pack(
+        "<4sI4s4sIHHIIHH4sI",
+        b"RIFF", 0xFFFFFFFF, b"WAVE", b"fmt ", 16, 1, channels, frame_rate,
+        frame_rate * channels * sample_width, channels * sample_width, sample_width * 8,
+        b"data", 0xFFFFFFFF,
+    )
+
+def read_wav(source):
+    with wave.open(source, "rb") as wav:
+        width = wav.getsampwidth()
+        frames = wav.readframes(wav.getnframes())
+        if width == 3:
+            # Widen 24-bit little-endian samples into the top bytes of an int32.
+            raw = np.frombuffer(frames, dtype=np.uint8).reshape(-1, 3).astype(np.int32)
+            samples = raw[:, 0] << 8 | raw[:, 1] << 16 | raw[:, 2] << 24
+        elif width in (1, 2, 4):
+            samples = np.frombuffer(frames, dtype={1: np.uint8, 2: np.int16, 4: np.int32}[width])
+        else:
+            raise ValueError(f"Unsupported WAV sample width: {width} bytes")
+        if wav.getnchannels() > 1:
+            samples = samples.reshape(-1, wav.getnchannels())
+        return wav.getframerate(), samples
+
+def synthesize_pcm_stream(text, voice_name=None):
+    path = None
+    try:
+        for sentence in SENTENCE_BOUNDARY.split(clip_text(text.strip())):
+            if not sentence:
+                continue
+            path = synthesize_tts(sentence, voice_name, output_path=path)
+            with wave.open(path, "rb") as wav:
+                yield wav.getparams(), wav.readframes(wav.getnframes())
+    finally:
+        if path is not None:
+            Path(path).unlink(missing_ok=True)
+
+def pcm_to_wav_chunks(pcm_stream):
+    header_sent = False
+    with contextlib.closing(pcm_stream):
+        for params, frames in pcm_stream:
+            if not header_sent:
+                yield streaming_wav_header(params.nchannels, params.sampwidth, params.framerate)
+                header_sent = True
+            yield frames
+
+def synthesize_tts_stream(text, voice_name=None):
+    return pcm_to_wav_chunks(synthesize_pcm_stream(text, voice_name))
+
+def warmup():
+    Path(synthesize_tts("warmup")).unlink(missing_ok=True)
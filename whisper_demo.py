@@ -1,7 +1,70 @@
-from faster_whisper import WhisperModel
+import os
+import threading
+import ctranslate2
+import numpy as np
 
-model = WhisperModel("base", device="cuda", compute_type="float16")
+MODEL_NAME = "base"
+DEVICE = "cuda" if ctranslate2.get_cuda_device_count() > 0 else "cpu"
+COMPUTE_TYPE = os.environ.get("WHISPER_COMPUTE_TYPE", "int8_float16" if DEVICE == "cuda" else "int8")
+BATCH_SIZE = int(os.environ.get("WHISPER_BATCH_SIZE", "8"))
+NUM_WORKERS = int(os.environ.get("WHISPER_NUM_WORKERS", "2"))
+CPU_THREADS = int(os.environ.get("WHISPER_THREADS", str(max(1, (os.cpu_count() or 1) // NUM_WORKERS))))
+MODEL_TAG = f"{MODEL_NAME}-{COMPUTE_TYPE}-b{BATCH_SIZE}"
+VAD_PARAMETERS = {"min_silence_duration_ms": 500, "speech_pad_ms": 200}
+FAST_DECODE_OPTIONS = {
+    "beam_size": 1,
+    "best_of": 1,
+    "temperature": 0.0,
+    "condition_on_previous_text": False,
+    "no_speech_threshold": 0.6,
+}
+ACCURATE_DECODE_OPTIONS = {"beam_size": 5}
 
-def transcribe_audio(audio_path):
-    segments, _ = model.transcribe(audio_path, beam_size=5)
+_model = None
+_batched_model = None
+_model_lock = threading.Lock()
+
+def get_model():
+    global _model, _batched_model
+    if _model is None:
+        with _model_lock:
+            if _model is None:
+                from faster_whisper import BatchedInferencePipeline, WhisperModel
+                from faster_whisper.utils import download_model
+
+                model_path = download_model(MODEL_NAME)
+                prefetch_weights(model_path)
+                model = WhisperModel(model_path, device=DEVICE, compute_type=COMPUTE_TYPE, cpu_threads=CPU_THREADS, num_workers=NUM_WORKERS)
+                _batched_model = BatchedInferencePipeline(model=model)
+                _model = model
+    return _model
+
+def prefetch_weights(model_path):
+    weights = os.path.join(model_path, "model.bin")
+    if not hasattr(os, "posix_fadvise") or not os.path.exists(weights):
+        return
+    with open(weights, "rb") as f:
+        os.posix_fadvise(f.fileno(), 0, 0, os.POSIX_FADV_WILLNEED)
+
+def is_loaded():
+    return _model is not None
+
+def cache_tag(vad_filter=True, fast=True):
+    tag = f"{MODEL_TAG}-{'fast' if fast else 'beam5'}"
+    return tag if vad_filter else f"{tag}-novad"
+
+def transcribe_audio(audio, vad_filter=True, fast=True):
+    model = get_model()
+    options = dict(FAST_DECODE_OPTIONS if fast else ACCURATE_DECODE_OPTIONS, vad_filter=vad_filter)
+    if vad_filter:
+        options["vad_parameters"] = dict(VAD_PARAMETERS)
+        if BATCH_SIZE > 1:
+            # The batched pipeline needs VAD chunk boundaries, so it is only used with VAD on.
+            model = _batched_model
+            options["batch_size"] = BATCH_SIZE
+    segments, _ = model.transcribe(audio, **options)
     return " ".join(segment.text for segment in segments)
+
+def warmup():
+    # VAD would drop silent audio before decoding, so warm up with it off to exercise the decoder.
+    transcribe_audio(np.zeros(8000, dtype=np.float32), vad_filter=False)